@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 """Generates languages, styles, etc. from pygments for use with
-source-highlight.
+source-highlight. Requires pygments, exrex, xonsh, and numpy.
 """
 import os
 import re
 import sys
 import time
 import inspect
+import functools
+import contextlib
+import weakref
 import itertools
+import multiprocessing
 from re import sre_parse
+from collections import namedtuple
 from pprint import pprint
 
 from pygments import lexers
@@ -17,8 +22,9 @@ from pygments.lexer import words, default, using, this, DelegatingLexer, RegexLe
 from pygments.token import Token
 
 import exrex
+import numpy as np
 
-from xonsh.color_tools import make_palette, find_closest_color, rgb_to_256
+from xonsh.color_tools import make_palette, rgb_to_256
 
 
 BASE_DIR = "share/py-source-highlight"
@@ -26,50 +32,176 @@ CURRENT_LEXER = None
 LEXER_STACK = None
 
 
+_QUOTE_SAFE_TABLE = str.maketrans({"'": r"\x27"})
+
+
 def quote_safe(s):
-    return s.replace("'", r"\x27")
+    return s.translate(_QUOTE_SAFE_TABLE)
 
 
+@functools.lru_cache(maxsize=None)
 def token_to_rulename(token):
     return str(token).replace(".", "_")
 
 
+_GROUP_CHARS_RE = re.compile(r"[()\[\]]")
+
+
 def top_level_groups(s):
     level = 0
     groups = []
     inrange = False
-    g = ""
-    for c in s:
-        g += c
+    start = 0
+    for m in _GROUP_CHARS_RE.finditer(s):
+        c = m.group(0)
         if not inrange and c == ")":
             level -= 1
             if level == 0:
-                groups.append(g)
-                g = ""
+                end = m.end()
+                groups.append(s[start:end])
+                start = end
         elif not inrange and c == "(":
             level += 1
         elif c == "[":
             inrange = True
         elif inrange and c == "]":
             inrange = False
-    if g:
-        groups.append(g)
+    if start < len(s):
+        groups.append(s[start:])
     return groups
 
 
+_EXREX_SAFE_RE = re.compile(r"\*\?|\+\?")
+_EXREX_SAFE_MAP = {"*?": "{0,100}", "+?": "{1,100}"}
+
+
 def exrex_safe(s):
     """Translates a regex string to be exrex safe, for some missed cases"""
-    return s.replace("*?", "{0,100}").replace("+?", "{1,100}")
+    return _EXREX_SAFE_RE.sub(lambda m: _EXREX_SAFE_MAP[m.group(0)], s)
 
 
-def longest_sample(regex, n=100, limit=100):
-    regex = exrex_safe(regex)
+SAMPLE_CATEGORY_CHARS = {
+    sre_parse.CATEGORY_DIGIT: "0",
+    sre_parse.CATEGORY_NOT_DIGIT: "a",
+    sre_parse.CATEGORY_SPACE: " ",
+    sre_parse.CATEGORY_NOT_SPACE: "a",
+    sre_parse.CATEGORY_WORD: "a",
+    sre_parse.CATEGORY_NOT_WORD: " ",
+}
+SAMPLE_CATEGORY_PATTERNS = {
+    sre_parse.CATEGORY_DIGIT: r"\d",
+    sre_parse.CATEGORY_NOT_DIGIT: r"\D",
+    sre_parse.CATEGORY_SPACE: r"\s",
+    sre_parse.CATEGORY_NOT_SPACE: r"\S",
+    sre_parse.CATEGORY_WORD: r"\w",
+    sre_parse.CATEGORY_NOT_WORD: r"\W",
+}
+# characters to try, in order, when sampling from a negated character set
+SAMPLE_NEGATED_CANDIDATES = "aZ0_ .,:;=-+*/#@!$%&?~|<>()[]{}'\"\\"
+
+
+class _UnsupportedNode(Exception):
+    """Raised when a regex node cannot be sampled by walking the regex."""
+
+
+def _in_set(c, items):
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            if c == chr(av):
+                return True
+        elif op == sre_parse.RANGE:
+            if av[0] <= ord(c) <= av[1]:
+                return True
+        elif op == sre_parse.CATEGORY and av in SAMPLE_CATEGORY_PATTERNS:
+            if re.fullmatch(SAMPLE_CATEGORY_PATTERNS[av], c) is not None:
+                return True
+        else:
+            raise _UnsupportedNode(f"cannot sample character set item {op}")
+    return False
+
+
+def _sample_in(items):
+    if items[0][0] == sre_parse.NEGATE:
+        for c in SAMPLE_NEGATED_CANDIDATES:
+            if not _in_set(c, items[1:]):
+                return c
+        raise _UnsupportedNode("cannot sample negated character set")
+    op, av = items[0]
+    if op == sre_parse.LITERAL:
+        return chr(av)
+    elif op == sre_parse.RANGE:
+        return chr(av[0])
+    elif op == sre_parse.CATEGORY and av in SAMPLE_CATEGORY_CHARS:
+        return SAMPLE_CATEGORY_CHARS[av]
+    raise _UnsupportedNode(f"cannot sample character set item {op}")
+
+
+def _sample_walk(sre_obj, limit, groups, prefix=""):
+    """Walks a parsed regex and deterministically builds a string that
+    it matches, without enumerating samples. The prefix is the part of the
+    sample that has already been built.
+    """
     s = ""
+    for op, av in sre_obj:
+        if op == sre_parse.LITERAL:
+            s += chr(av)
+        elif op == sre_parse.NOT_LITERAL:
+            s += "b" if chr(av) == "a" else "a"
+        elif op == sre_parse.ANY:
+            s += "a"
+        elif op == sre_parse.IN:
+            s += _sample_in(av)
+        elif op == sre_parse.CATEGORY and av in SAMPLE_CATEGORY_CHARS:
+            s += SAMPLE_CATEGORY_CHARS[av]
+        elif op == sre_parse.AT:
+            pass
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, sub = av
+            # take one pass through optional repeats so that the sample is
+            # informative, except at the very start of the sample, where
+            # they are usually leading whitespace.
+            if prefix or s:
+                count = min(max(low, 1), high, limit)
+            else:
+                count = min(low, limit)
+            for _ in range(count):
+                s += _sample_walk(sub, limit, groups, prefix + s)
+        elif op == sre_parse.BRANCH:
+            s += max((_sample_walk(b, limit, groups, prefix + s) for b in av[1]), key=len)
+        elif op == sre_parse.SUBPATTERN:
+            sub = _sample_walk(av[3], limit, groups, prefix + s)
+            if av[0] is not None:
+                groups[av[0]] = sub
+            s += sub
+        elif op == sre_parse.GROUPREF and av in groups:
+            s += groups[av]
+        else:
+            raise _UnsupportedNode(f"cannot sample regex node {op}")
+    return s
+
+
+def sample_match(regex, n=100, limit=100):
+    """Returns a string matching the regex. If the regex cannot be walked
+    directly, or walking it gives an empty sample, this falls back to the
+    first non-empty one of the first n exrex samples. An empty sample
+    would make the using() callback lex nothing, and the token would
+    silently become Token.Text.
+    """
+    try:
+        s = _sample_walk(sre_parse.parse(regex), limit, {})
+    except (_UnsupportedNode, re.error):
+        pass
+    else:
+        s = s.replace("\n", "").replace("\r", "")
+        if s:
+            return s
+    # fall back to sampling from exrex
+    regex = exrex_safe(regex)
     for i, t in zip(range(n), exrex.generate(regex, limit=limit)):
         t = t.replace("\n", "").replace("\r", "")
-        if len(t) > len(s):
-            s = t
-    return s
+        if t:
+            return t
+    return ""
 
 
 GETONE_MATCH_LENGTH = {
@@ -97,7 +229,7 @@ def getone_match(regex, n=None, replace_newlines=True):
 
 
 def get_match(regex):
-    sample = longest_sample(regex)
+    sample = sample_match(regex)
     m = re.match(regex, sample)
     if m is not None:
         return m
@@ -110,21 +242,28 @@ def get_match(regex):
     raise ValueError("cannot compute callback")
 
 
-def token_from_using(callback, regex):
-    global CURRENT_LEXER
-    lexer = CURRENT_LEXER
+@functools.lru_cache(maxsize=None)
+def _token_from_using_cached(lexer, callback, regex):
     try:
         m = get_match(regex)
     except Exception:
         return Token.Text
     try:
         _, token, _ = next(callback(lexer, m))
-    except StopIteration:
+    except Exception:
+        # the callback lexed nothing, or the sample led it into a state
+        # that it cannot handle on its own
         token = Token.Text
     return token
 
 
+def token_from_using(callback, regex):
+    global CURRENT_LEXER
+    return _token_from_using_cached(CURRENT_LEXER, callback, regex)
+
+
 UNCAPTURED_GROUP_PREFIXES = ["(?:", "(?=", "(?!", "(?<=", "(?<!"]
+UNCAPTURED_PREFIX_RE = re.compile("|".join(map(re.escape, UNCAPTURED_GROUP_PREFIXES)))
 
 
 class EchoTranslator:
@@ -483,20 +622,23 @@ def bygroup_translator(regex, bg, **kwargs):
     except Exception:
         print(f"Original Regex is: {orig_regex!r}")
         raise
-    for prefix in UNCAPTURED_GROUP_PREFIXES:
-        if prefix in regex:
-            groups = top_level_groups(orig_regex)
-            gmsg = "\n------\n".join(groups)
-            troups = top_level_groups(regex)
-            tmsg = "\n------\n".join(troups)
-            raise ValueError(
-                f"uncaptured prefix {prefix!r} is in regex '{regex}' "
-                "that is being applied to a bygroup transformation. "
-                "\n\nTop level groups of original regex:\n\n"
-                + gmsg
-                + "\n\nTop level groups of transformed regex:\n\n"
-                + tmsg
-            )
+    # source-highlight maps every group to a token, so an uncaptured group
+    # anywhere in the transformed regex (not just at the start) is an error
+    m = UNCAPTURED_PREFIX_RE.search(regex)
+    if m is not None:
+        prefix = m.group(0)
+        groups = top_level_groups(orig_regex)
+        gmsg = "\n------\n".join(groups)
+        troups = top_level_groups(regex)
+        tmsg = "\n------\n".join(troups)
+        raise ValueError(
+            f"uncaptured prefix {prefix!r} is in regex '{regex}' "
+            "that is being applied to a bygroup transformation. "
+            "\n\nTop level groups of original regex:\n\n"
+            + gmsg
+            + "\n\nTop level groups of transformed regex:\n\n"
+            + tmsg
+        )
     rule = "(" + ",".join(token_names) + ") = `" + regex + "`"
     return rule
 
@@ -506,7 +648,8 @@ def using_translator_other(regex, callback, nonlocals, level=0, **kwargs):
     lexer_class = nonlocals["_other"]
     CURRENT_LEXER = lexer = lexer_class()
     LEXER_STACK.append(lexer)
-    rules = genrulelines(lexer, level=level)
+    # consume the rules now, while the other lexer is on the stack
+    rules = list(genrulelines(lexer, level=level))
     del LEXER_STACK[-1]
     CURRENT_LEXER = LEXER_STACK[-1]
     return rules
@@ -516,7 +659,7 @@ def using_translator_stack(regex, callback, nonlocals, level=0, **kwargs):
     global CURRENT_LEXER, LEXER_STACK
     stack = nonlocals["gt_kwargs"]["stack"]
     lexer = CURRENT_LEXER
-    rules = genrulelines(lexer, state_key=stack[-1], level=level)
+    rules = list(genrulelines(lexer, state_key=stack[-1], level=level))
     return rules
 
 
@@ -541,10 +684,26 @@ CALLABLE_RULES = {
 }
 
 
+_WORDS_CACHE = weakref.WeakKeyDictionary()
+
+
+def words_to_regex(w):
+    """Returns the regex for a words() instance, building it only once."""
+    regex = _WORDS_CACHE.get(w)
+    if regex is None:
+        regex = _WORDS_CACHE[w] = w.get()
+    return regex
+
+
+# matches regexes that run to the end of the line, i.e. end in "\n" or ".*",
+# optionally preceded by another ".*", capturing the rest of the regex
+_TAIL_RE = re.compile(r"(.*?)(?:\.\*)?(?:\\n|\.\*)", re.DOTALL)
+
+
 def regex_to_rule(regex, token, action="#none", level=0):
     # some prep
     if isinstance(regex, words):
-        regex = regex.get()
+        regex = words_to_regex(regex)
     # determine rule
     if callable(token):
         name = token.__qualname__
@@ -562,17 +721,16 @@ def regex_to_rule(regex, token, action="#none", level=0):
             )
     elif regex == "\\n" and action == "#pop":
         rule = token_to_rulename(token) + " = '$'"
-    elif regex.endswith("\\n") or regex.endswith(".*"):
-        rule = token_to_rulename(token)
-        regex = regex[:-2]
-        if regex.endswith(".*"):
-            regex = regex[:-2]
-        if not regex:
-            return ""
-        rule += " start '" + quote_safe(regex) + "'"
     else:
         rule = token_to_rulename(token)
-        rule += " = '" + quote_safe(regex) + "'"
+        m = _TAIL_RE.fullmatch(regex)
+        if m is None:
+            rule += " = '" + quote_safe(regex) + "'"
+        else:
+            regex = m.group(1)
+            if not regex:
+                return ""
+            rule += " start '" + quote_safe(regex) + "'"
     return rule
 
 
@@ -599,6 +757,20 @@ def group_regexes(elems):
     return grouped
 
 
+@functools.lru_cache(maxsize=None)
+def _push_state_info(lexer, state_key):
+    """Computes the delimiters and the remaining rules of a state that
+    contains #push elements. This only depends on the state, so it is
+    computed once rather than for every #push element.
+    """
+    elems = ensure_elems(lexer, state_key, None)
+    pushers, poppers, others = _push_pop_other(elems)
+    push_delim = group_regexes(pushers)
+    pop_delim = group_regexes(poppers)
+    multiline = ("\n" in push_delim) or ("\n" in pop_delim)
+    return push_delim, pop_delim, multiline, others
+
+
 VARIANTS = (
     "full",
     "basic",
@@ -659,18 +831,33 @@ def ensure_elems(lexer, state_key, elems, check_delegating=True):
     return elems
 
 
-def return_to_root(lines, indent):
-    # go back to root
-    if len(lines) == 0:
-        return
-    prev2 = set(lines[-1].split()[-2:])
+def return_to_root(last, indent):
+    """Returns the line that goes back to root after the last line, if any."""
+    if last is None:
+        return None
+    prev2 = set(last.split()[-2:])
     if "exit" not in prev2 and "exitall" not in prev2:
-        lines.append(indent + "exitall")
+        return indent + "exitall"
+    return None
+
 
+# maximum depth of nested genrulelines() generators. Every yielded line passes
+# back up through each level of the yield from chain, so runaway nesting is
+# cut off early rather than left to reach Python's recursion limit slowly.
+MAX_RULE_DEPTH = 100
 
-def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
+
+def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None, depth=0):
+    """Yields the non-blank rule lines for a lexer state. The return value
+    of the generator is the last line yielded, so that callers can tell
+    whether they still need to go back to root.
+    """
     global LEXER_STACK
-    lines = []
+    if depth > MAX_RULE_DEPTH:
+        raise RecursionError(
+            f"lexer states nested more than {MAX_RULE_DEPTH} levels deep"
+        )
+    last = None
     indent = "  " * level
     elems = ensure_elems(lexer, state_key, elems)
     if elems is None:
@@ -682,7 +869,7 @@ def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
         pass
     elif state_key in stack:
         # need to prevent recurrsion
-        return []
+        return None
     else:
         stack.append(state_key)
     needle = lexer.needle if isinstance(lexer, DelegatingLexer) else None
@@ -691,16 +878,19 @@ def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
             # translate default statements into equivalent tuples
             elem = ("", Token.Text, elem.state)
         n = len(elem)
+        lines = []
         if isinstance(elem, str):
             if elem == "root":
-                return_to_root(lines, indent)
+                lines.append(return_to_root(last, indent))
             elif elem == 'statements' and state_key == 'statement':
                 import pdb; pdb.set_trace()
             else:
                 # dive into new state
-                lines.extend(
-                    genrulelines(lexer, state_key=elem, level=level, stack=stack)
-                )
+                last = (
+                    yield from genrulelines(
+                        lexer, state_key=elem, level=level, stack=stack, depth=depth + 1
+                    )
+                ) or last
         elif n >= 2 and needle is not None and elem[1] is needle:
             # in a delegating lexer that is pointing us elsewhere
             if n == 2:
@@ -715,11 +905,11 @@ def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
                 regex, token = elem[:2]
                 enter_state = 'root'
             rule = regex_to_rule(regex, token)
-            lines.append(indent + "# delegating to " + lexer.root_lexer.name + " lexer")
-            lines.append(indent + "state " + rule + " begin")
+            yield indent + "# delegating to " + lexer.root_lexer.name + " lexer"
+            yield indent + "state " + rule + " begin"
             # delegating lexers always delegate to root state
             LEXER_STACK.append(lexer.root_lexer)
-            lines.extend(genrulelines(lexer.root_lexer, state_key=enter_state, level=level + 1, stack=stack))
+            yield from genrulelines(lexer.root_lexer, state_key=enter_state, level=level + 1, stack=stack, depth=depth + 1)
             del LEXER_STACK[-1]
             lines.append(indent + "end")
         elif n == 2:
@@ -730,38 +920,35 @@ def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
             else:
                 lines.extend(rule)
         elif n == 3 and isinstance(elem[2], str) and elem[2] == "root":
-            return_to_root(lines, indent)
+            lines.append(return_to_root(last, indent))
         elif n == 3 and isinstance(elem[2], str) and not elem[2].startswith("#"):
             regex, token, key = elem
             rule = regex_to_rule(regex, token)
-            lines.append(indent + "# " + key + " state")
-            lines.append(indent + "state " + rule + " begin")
-            lines.extend(
-                genrulelines(lexer, state_key=key, level=level + 1, stack=stack)
+            yield indent + "# " + key + " state"
+            yield indent + "state " + rule + " begin"
+            yield from genrulelines(
+                lexer, state_key=key, level=level + 1, stack=stack, depth=depth + 1
             )
             lines.append(indent + "end")
         elif n == 3 and elem[2] == "#push":
-            new_elems = ensure_elems(lexer, state_key, None)
-            pushers, poppers, others = _push_pop_other(new_elems)
-            push_delim = group_regexes(pushers)
-            pop_delim = group_regexes(poppers)
-            multiline = ("\n" in push_delim) or ("\n" in pop_delim)
+            push_delim, pop_delim, multiline, others = _push_state_info(
+                lexer, state_key
+            )
             token = elem[1]
             token_name = token_to_rulename(token)
-            rule = token_name + " delim '" + quote_safe(push_delim) + "' '"
-            rule += quote_safe(pop_delim) + "' "
-            if multiline:
-                rule += "multiline "
-            rule += "nested"
+            rule = (
+                f"{token_name} delim '{quote_safe(push_delim)}' "
+                f"'{quote_safe(pop_delim)}' {'multiline ' if multiline else ''}nested"
+            )
             if len(others) == 0:
                 # no internal highlighting rules, just nested
                 lines.append(indent + rule)
             else:
                 # nested with internal highlighting
-                lines.append(indent + "# nested " + state_key + " state")
-                lines.append(indent + "state " + rule + " begin")
-                lines.extend(
-                    genrulelines(lexer, elems=others, level=level + 1, stack=stack)
+                yield indent + "# nested " + state_key + " state"
+                yield indent + "state " + rule + " begin"
+                yield from genrulelines(
+                    lexer, elems=others, level=level + 1, stack=stack, depth=depth + 1
                 )
                 lines.append(indent + "end")
         elif n == 3 and isinstance(elem[2], str) and elem[2].startswith("#pop"):
@@ -784,18 +971,24 @@ def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
                 elif key.startswith("#"):
                     raise ValueError("Don't know how to interpret action")
                 elif key == "root":
-                    return_to_root(lines, "  " * (level + 1 + i))
+                    line = return_to_root(last, "  " * (level + 1 + i))
+                    if line is not None:
+                        yield line
+                        last = line
                 else:
-                    lines.append(indent + "# " + key + " state")
                     if not isinstance(rule, str):
-                        rule = next(rule)
-                    lines.append(indent + "state " + rule + " begin")
-                    lines.extend(
-                        genrulelines(
-                            lexer, state_key=key, level=level + 1 + i, stack=stack
-                        )
+                        rule = next(iter(rule))
+                    yield indent + "# " + key + " state"
+                    yield indent + "state " + rule + " begin"
+                    yield from genrulelines(
+                        lexer,
+                        state_key=key,
+                        level=level + 1 + i,
+                        stack=stack,
+                        depth=depth + 1,
                     )
-                    lines.append(indent + "end")
+                    last = indent + "end"
+                    yield last
                     stack.append(key)
                     nstack += 1
                 regex = ".*?"
@@ -803,52 +996,67 @@ def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
             del stack[-nstack:]
         else:
             raise ValueError("Could not interpret: " + repr(elem))
+        for line in lines:
+            if line is not None and line.strip():
+                yield line
+                last = line
     if len(stack) == 0:
         stack.append("root")
     elif len(stack) == 1:
         pass
     else:
         del stack[-1]
-    lines = filter(str.strip, lines)
-    return lines
+    return last
+
+
+def write_lines(fname, lines, **kwargs):
+    """Writes lines to a file as they are generated. The output goes to a
+    temporary file that only replaces fname once all lines have been
+    written, so that a failure does not leave a truncated file behind.
+    """
+    # the temp name is unique per process, so that concurrent writers of the
+    # same file never share or remove each other's temp file
+    tmpname = f"{fname}.{os.getpid()}.tmp"
+    try:
+        with open(tmpname, "w", **kwargs) as f:
+            f.writelines(line + "\n" for line in lines)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmpname)
+        raise
+    os.replace(tmpname, fname)
+
+
+def lang_file_name(name):
+    """Returns the language file that a lexer with the given name is
+    written to. Distinct lexers may share one, e.g. C and C++.
+    """
+    norm_name = name.lower().replace(" ", "-").replace("+", "").replace("/", "")
+    return os.path.join(BASE_DIR, norm_name + ".lang")
 
 
 def genlang(lexer):
-    lines = ["# autogenerated from pygments for " + lexer.name]
-    lines.extend(genrulelines(lexer))
-    lang = "\n".join(lines) + "\n"
-    norm_name = lexer.name.lower().replace(" ", "-").replace("+", "").replace("/", "")
-    fname = os.path.join(BASE_DIR, norm_name + ".lang")
-    with open(fname, "w", errors="backslashreplace") as f:
-        f.write(lang)
+    fname = lang_file_name(lexer.name)
+    header = "# autogenerated from pygments for " + lexer.name
+    lines = itertools.chain([header], genrulelines(lexer))
+    write_lines(fname, lines, errors="backslashreplace")
     return fname
 
 
 def add_to_lang_map(lexer, base, lang_map):
-    lang_map[lexer.name] = base
-    lang_map[lexer.name.lower()] = base
-    for alias in lexer.aliases:
-        lang_map[alias] = base
-        lang_map[alias.lower()] = base
-    for filename in lexer.filenames:
-        _, _, name = filename.rpartition(".")
-        lang_map[name] = base
-        lang_map[name.lower()] = base
-    for filename in lexer.alias_filenames:
-        _, _, name = filename.rpartition(".")
-        lang_map[name] = base
-        lang_map[name.lower()] = base
+    names = {lexer.name, *lexer.aliases}
+    for filename in itertools.chain(lexer.filenames, lexer.alias_filenames):
+        names.add(filename.rpartition(".")[2])
+    names.update([name.lower() for name in names])
+    lang_map.update(dict.fromkeys(names, base))
 
 
 def write_lang_map(lang_map, base="lang.map"):
     print("Writing " + base)
-    lines = []
-    for key, value in sorted(lang_map.items()):
-        lines.append(key + " = " + value)
-    s = "\n".join(lines) + "\n"
     fname = os.path.join(BASE_DIR, base)
     with open(fname, "w") as f:
-        f.write(s)
+        for key in sorted(lang_map):
+            f.write(f"{key} = {lang_map[key]}\n")
 
 
 def get_lexer_from_lookup(name, lookups):
@@ -873,28 +1081,76 @@ def get_lexer_from_lookup(name, lookups):
     raise RuntimeError("could not find lexer " + name)
 
 
-def genlangs():
+LexerInfo = namedtuple("LexerInfo", ["name", "aliases", "filenames", "alias_filenames"])
+LEXER_LOOKUPS = None
+
+
+def _init_genlang_worker(lexer_lookups):
+    global LEXER_LOOKUPS
+    LEXER_LOOKUPS = lexer_lookups
+
+
+def _genlang_one(lexer_name):
+    """Generates a single language file. Returns the file name and the
+    lexer info needed for the lang map, or None if the lexer was skipped.
+    """
     global CURRENT_LEXER, LEXER_STACK
+    lexer = get_lexer_from_lookup(lexer_name, LEXER_LOOKUPS)
+    if not isinstance(lexer, (RegexLexer, DelegatingLexer)):
+        print(
+            "Skipping " + lexer_name + " because it is not "
+            "a RegexLexer or Delegating lexer.",
+            flush=True,
+        )
+        return None
+    print("Generating lexer " + lexer_name, flush=True)
+    CURRENT_LEXER = lexer
+    LEXER_STACK = [lexer]
+    try:
+        fname = genlang(lexer)
+    finally:
+        # pool workers are reused, so never hold onto this lexer
+        _token_from_using_cached.cache_clear()
+        _push_state_info.cache_clear()
+        CURRENT_LEXER = LEXER_STACK = None
+    info = LexerInfo(lexer.name, lexer.aliases, lexer.filenames, lexer.alias_filenames)
+    return fname, info
+
+
+def _genlang_worker(lexer_names):
+    """Generates the lexers that share a language file in a worker process.
+    They run in order, so that the last one wins, as in a sequential run.
+    """
+    return [_genlang_one(lexer_name) for lexer_name in lexer_names]
+
+
+def genlangs():
     # lexer_names = ["ActionScript3", "diff", "ini", "pkgconfig", "c"]
     # lexer_names = ["adl"]
     lexer_lookups = {x[0]: x for x in lexers.get_all_lexers()}
     lexer_names = list(lexer_lookups.keys())
+    # lexers that write the same file must not run concurrently
+    shared_files = {}
+    for lexer_name in lexer_names:
+        shared_files.setdefault(lang_file_name(lexer_name), []).append(lexer_name)
+    tasks = list(shared_files.values())
+    # otherwise lexers are independent of one another, so generate in parallel
+    with multiprocessing.Pool(
+        initializer=_init_genlang_worker, initargs=(lexer_lookups,)
+    ) as pool:
+        task_results = pool.map(_genlang_worker, tasks, chunksize=1)
+    results = {}
+    for task, task_result in zip(tasks, task_results):
+        results.update(zip(task, task_result))
+    # merge in the original lexer order, so later lexers take precedence
     lang_map = {}
     for lexer_name in lexer_names:
-        lexer = get_lexer_from_lookup(lexer_name, lexer_lookups)
-        if not isinstance(lexer, (RegexLexer, DelegatingLexer)):
-            print(
-                "Skipping " + lexer_name + " because it is not "
-                "a RegexLexer or Delegating lexer."
-            )
+        result = results[lexer_name]
+        if result is None:
             continue
-        print("Generating lexer " + lexer_name)
-        CURRENT_LEXER = lexer
-        LEXER_STACK = [lexer]
-        fname = genlang(lexer)
+        fname, info = result
         base = os.path.basename(fname)
-        add_to_lang_map(lexer, base, lang_map)
-    CURRENT_LEXER = None
+        add_to_lang_map(info, base, lang_map)
     write_lang_map(lang_map)
 
 
@@ -923,67 +1179,92 @@ LOGICAL_COLORS = {
     "white": (255, 255, 255),
 }
 MODIFIER_TRANSLATIONS = {"bold": "b", "italic": "i", "underline": "u"}
+# classifies each whitespace-separated part of a pygments style string as
+# a (background) color, a modifier, or something that cannot be translated
+_COLOR_PART_RE = re.compile(
+    r"(bg:)?#(\S*)|(" + "|".join(MODIFIER_TRANSLATIONS) + r")(?!\S)|(\S+)"
+)
 
 
 def pygments_to_srchilite_color(color, hexes_to_names):
-    parts = color.split()
     translated = []
     modifiers = []
-    for part in parts:
-        if part.startswith("#"):
-            translated.append(hexes_to_names[part[1:]])
-        elif part.startswith("bg:#"):
-            translated.append("bg:" + hexes_to_names[part[4:]])
-        elif part in MODIFIER_TRANSLATIONS:
-            modifiers.append(MODIFIER_TRANSLATIONS[part])
-        else:
+    for m in _COLOR_PART_RE.finditer(color):
+        bg, hexcolor, modifier, unknown = m.groups()
+        if unknown is not None:
             raise ValueError(f"could not translate pygments color {color!r}.")
+        elif modifier is not None:
+            modifiers.append(MODIFIER_TRANSLATIONS[modifier])
+        elif bg is None:
+            translated.append(hexes_to_names[hexcolor])
+        else:
+            translated.append("bg:" + hexes_to_names[hexcolor])
     if modifiers:
         translated.append(", ".join(modifiers))
     rtn = " ".join(translated)
     return rtn
 
 
+@functools.lru_cache(maxsize=None)
+def _find_token_color(style, token, default):
+    """Resolves the color of a token in a style, inheriting from the
+    token's parents when the token's own color is empty.
+    """
+    color = style.styles.get(token, default)
+    if color is None:
+        return default
+    elif color:
+        return color
+    return _find_token_color(style, token.parent, default)
+
+
 def find_token_color(style, token, color, default="#000000"):
-    while not color:
-        if color is None:
-            color = default
-        elif len(color) == 0:
-            token = token.parent
-            color = style.styles.get(token, default)
-        else:
-            raise ValueError("could not find token color")
-    return color
+    if color is None:
+        return default
+    elif color:
+        return color
+    return _find_token_color(style, token.parent, default)
 
 
 def make_color_translators(palette):
-    """Makes style translation dicts based on a color palette."""
+    """Makes style translation dicts based on a color palette, along with
+    the brightest of the translated colors.
+    """
     names_to_hexes = {}
     hexes_to_names = {}
     names_to_short = {}
     short_to_names = {}
-    for name, t in LOGICAL_COLORS.items():
-        color = find_closest_color(t, palette)
+    # find the closest palette color to each logical color all at once,
+    # breaking ties in favor of the reverse-sorted hexes, like xonsh's
+    # find_closest_color() does
+    hexes = sorted(palette.keys(), reverse=True)
+    pal = np.asarray([palette[h] for h in hexes], dtype=np.int32)
+    logical = np.asarray(list(LOGICAL_COLORS.values()), dtype=np.int32)
+    dists = ((logical[:, None, :] - pal[None, :, :]) ** 2).sum(-1)
+    closest = dists.argmin(1)
+    for name, idx in zip(LOGICAL_COLORS.keys(), closest):
+        color = hexes[idx]
         names_to_hexes[name] = color
         hexes_to_names[color] = name
         short = rgb_to_256(color)[0]
         names_to_short[name] = short
         short_to_names[short] = name
-    return names_to_hexes, hexes_to_names, names_to_short, short_to_names
+    brightest = max(names_to_hexes.values(), key=lambda h: sum(palette[h]))
+    return names_to_hexes, hexes_to_names, names_to_short, short_to_names, brightest
 
 
-def genstyle(style, style_name, hexes_to_names):
-    lines = []
-    fgcolor = "#" + max(hexes_to_names.keys())
+def genstylelines(style, hexes_to_names, fgcolor):
     for token, color in sorted(style.styles.items()):
         rulename = token_to_rulename(token)
         color = find_token_color(style, token, color, default=fgcolor)
         shcolor = pygments_to_srchilite_color(color, hexes_to_names)
-        lines.append(rulename + " " + shcolor + ";")
-    s = "\n".join(lines) + "\n"
+        yield rulename + " " + shcolor + ";"
+
+
+def genstyle(style, style_name, hexes_to_names, brightest):
+    fgcolor = "#" + brightest
     fname = os.path.join(BASE_DIR, style_name.lower() + ".style")
-    with open(fname, "w") as f:
-        f.write(s)
+    write_lines(fname, genstylelines(style, hexes_to_names, fgcolor))
     return fname
 
 
@@ -1020,7 +1301,7 @@ def genstyles():
         style = styles.get_style_by_name(style_name)
         palette = make_palette(style.styles.values())
         translators = make_color_translators(palette)
-        fname = genstyle(style, style_name, translators[1])
+        fname = genstyle(style, style_name, translators[1], translators[4])
         fname = genstyle_esc256outlang(style_name, translators[2])
         base = os.path.basename(fname)
         ol = os.path.splitext(base)[0]
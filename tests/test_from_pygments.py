@@ -0,0 +1,52 @@
+"""Tests sampling using() groups in the from-pygments script"""
+import os
+import re
+import importlib.util
+
+import pytest
+
+pytest.importorskip("pygments")
+pytest.importorskip("exrex")
+pytest.importorskip("numpy")
+pytest.importorskip("xonsh.color_tools")
+
+from pygments.lexer import using, this
+from pygments.lexers import GroovyLexer, DockerLexer, BashLexer, JsonLexer
+from pygments.token import Token
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(__file__)), "from-pygments.py")
+
+
+@pytest.fixture(scope="module")
+def fp():
+    spec = importlib.util.spec_from_file_location("from_pygments", SCRIPT)
+    mod = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(mod)
+    except ImportError as e:
+        pytest.skip(f"cannot load from-pygments.py: {e}")
+    return mod
+
+
+@pytest.mark.parametrize(
+    "lexer_cls, callback, group, exp",
+    [
+        # leading whitespace must not become the return type token
+        (GroovyLexer, using(this), r"^(\s*(?:[a-zA-Z_][\w.\[\]]*\s+)+?)", Token.Name),
+        (
+            DockerLexer,
+            using(BashLexer),
+            r"(((?:\s*\\?\s*)\w+=\w+(?:\s*\\?\s*))*)",
+            Token.Name.Variable,
+        ),
+        (DockerLexer, using(JsonLexer), r"(\[.*?\])", Token.Punctuation),
+    ],
+)
+def test_token_from_using(fp, monkeypatch, lexer_cls, callback, group, exp):
+    sample = fp.sample_match(group)
+    assert re.match(group, sample) is not None
+    assert not sample[:1].isspace()
+    fp._token_from_using_cached.cache_clear()
+    monkeypatch.setattr(fp, "CURRENT_LEXER", lexer_cls())
+    assert fp.token_from_using(callback, group) == exp